@@ -0,0 +1,534 @@
+"""
+The mapped module defines the classes necessary to work with
+finite-volume data on a mapped (curvilinear) grid.
+
+The physical grid is described by a map from the computational
+coordinates (x, y) to the physical coordinates (X(x, y), Y(x, y)).
+The map is given symbolically (using sympy), and from it we construct
+the metric terms needed by the solvers:
+
+* ``kappa`` : the area element of the physical cell, evaluated at cell
+  centers
+
+* ``hx``, ``hy`` : the line elements of the cell faces, evaluated on
+  the x- and y-interfaces respectively
+
+* ``R_fcx``, ``R_fcy`` : the rotation matrices that take a vector from
+  the computational frame into the frame normal and tangential to the
+  x- and y-interfaces
+
+Typical usage::
+
+   def map_func(myg):
+       return sympy.Matrix([mapped.x * sympy.cos(mapped.y),
+                            mapped.x * sympy.sin(mapped.y)])
+
+   grid = MappedGrid2d(map_func, nx, ny)
+
+The maps are assumed to be orthogonal (so that the rotation matrices
+are orthogonal as well).
+"""
+
+from __future__ import print_function
+
+import copy
+import functools
+import logging
+import os
+
+import numpy as np
+from numpy.testing import assert_array_almost_equal
+
+import sympy
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from util import msg
+
+import mesh.array_indexer as ai
+from mesh.patch import Grid2d, CellCenterData2d
+
+# the symbols used by the map functions.  z is the out-of-plane
+# coordinate -- we carry it so that we can take cross products of the
+# coordinate tangent vectors.
+x, y, z = sympy.symbols("x y z")
+
+log = logging.getLogger(__name__)
+
+
+def _lambdify_grid(expr):
+    """
+    lambdify a symbolic expression of (x, y) for evaluation on the
+    full grid.
+
+    If the PYRO_MAPPED_CODEGEN environment variable is set, we first
+    try sympy's ufuncify, which emits C code for the expression and
+    compiles it into a native ufunc.  Otherwise, if numba is
+    available, the scalar function is compiled into a parallel ufunc,
+    fusing the arithmetic into a single loop over the grid.  Failing
+    both, we fall back to a plain numpy lambdify.
+    """
+
+    if os.environ.get("PYRO_MAPPED_CODEGEN") and expr.free_symbols:
+        try:
+            from sympy.utilities.autowrap import ufuncify
+            return ufuncify((x, y), expr)
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    if numba is not None and expr.free_symbols:
+        # numba cannot handle sympy's exact integer literals (they
+        # are arbitrary precision), so force them to floats first
+        expr_f = expr.xreplace({n: sympy.Float(n)
+                                for n in expr.atoms(sympy.Integer)})
+        f = sympy.lambdify((x, y), expr_f, modules=["math"])
+        try:
+            return numba.vectorize(["float64(float64, float64)"],
+                                   target="parallel", nopython=True)(f)
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+    return sympy.lambdify((x, y), expr, modules="numpy")
+
+
+def _eval_grid(expr, xs, ys, shape):
+    """
+    evaluate a symbolic expression of (x, y) on the broadcast
+    coordinate vectors xs, ys, returning a float64 array of the given
+    shape.
+
+    If the expression separates as f(x)*g(y) -- as it does for polar
+    and axis-aligned stretched maps -- the factors are evaluated
+    independently, O(qx + qy) evaluations instead of O(qx*qy), and
+    combined by broadcasting.
+    """
+
+    if expr.free_symbols:
+        sep = sympy.separatevars(expr, symbols=[x, y], dict=True)
+        if sep is not None:
+            fx = sympy.lambdify(x, sep[x], modules="numpy")
+            gy = sympy.lambdify(y, sep[y], modules="numpy")
+            return np.broadcast_to(
+                np.asarray(float(sep["coeff"]) * fx(xs) * gy(ys),
+                           dtype=np.float64), shape)
+
+    return np.broadcast_to(
+        np.asarray(_lambdify_grid(expr)(xs, ys), dtype=np.float64),
+        shape)
+
+
+def _norm(vec):
+    """ the norm of a symbolic vector """
+    return sympy.sqrt(sum(c**2 for c in vec))
+
+
+# the symbolic manipulations below (in particular simplify) can take
+# seconds for a nontrivial map, so we cache them on the (immutable)
+# map expression.  This way repeated grid constructions with the same
+# map -- parameter sweeps, convergence studies, tests -- only pay the
+# cost once.
+
+@functools.lru_cache(maxsize=None)
+def _sym_area_element(map_expr):
+    """ the symbolic area element of map_expr (see sym_area_element) """
+
+    p1 = tuple(c.diff(x) for c in map_expr)
+    p2 = tuple(c.diff(y) for c in map_expr)
+
+    cross = (p1[1]*p2[2] - p1[2]*p2[1],
+             p1[2]*p2[0] - p1[0]*p2[2],
+             p1[0]*p2[1] - p1[1]*p2[0])
+
+    return sympy.simplify(_norm(cross))
+
+
+@functools.lru_cache(maxsize=None)
+def _sym_line_elements(map_expr):
+    """ the symbolic line elements of map_expr (see sym_line_elements) """
+
+    p1 = tuple(c.diff(x) for c in map_expr)
+    p2 = tuple(c.diff(y) for c in map_expr)
+
+    sym_hx = sympy.simplify(_norm(p2))
+    sym_hy = sympy.simplify(_norm(p1))
+
+    return sym_hx, sym_hy
+
+
+@functools.lru_cache(maxsize=None)
+def _sym_rotation_matrix(map_expr):
+    """ the symbolic rotation matrices of map_expr (see
+    sym_rotation_matrix) """
+
+    # assemble the matrices from the raw derivatives and normalize
+    # the rows -- we hold off on simplify until each matrix is fully
+    # built, so the (expensive) simplification runs once per matrix
+    Rx = sympy.Matrix(
+        [[map_expr[0].diff(x), map_expr[1].diff(x)],
+         [map_expr[0].diff(y), map_expr[1].diff(y)]])
+
+    Rx[0, :] = Rx[0, :] / _norm(Rx[0, :])
+    Rx[1, :] = Rx[1, :] / _norm(Rx[1, :])
+
+    Rx = sympy.simplify(Rx)
+
+    Ry = sympy.Matrix(
+        [[map_expr[0].diff(y), map_expr[1].diff(y)],
+         [map_expr[0].diff(x), map_expr[1].diff(x)]])
+
+    Ry[0, :] = Ry[0, :] / _norm(Ry[0, :])
+    Ry[1, :] = Ry[1, :] / _norm(Ry[1, :])
+
+    Ry = sympy.simplify(Ry)
+
+    # sanity check: for an orthogonal map, the rotation matrices must
+    # be orthogonal, R R^T = I.  The symbolic product and subs are
+    # expensive, so this only runs when explicitly asked for -- the
+    # unit tests exercise the same check.
+    if os.environ.get("PYRO_CHECK_METRICS"):
+        xx = np.random.rand()
+        yy = np.random.rand()
+
+        # evaluate entry-by-entry through the math module -- scalar
+        # calls there are far cheaper than a sympy subs()
+        for R in [Rx, Ry]:
+            RRT = R @ R.T
+            assert_array_almost_equal(
+                np.array([[sympy.lambdify((x, y), RRT[a, b],
+                                          modules=["math"])(xx, yy)
+                           for b in range(2)] for a in range(2)]),
+                np.eye(2))
+
+    return Rx, Ry
+
+
+class MappedGrid2d(Grid2d):
+    """
+    the mapped 2-d grid class.  This is built from a regular Grid2d in
+    computational coordinates together with a symbolic map to the
+    physical coordinates, from which we calculate the grid's metric
+    terms.
+    """
+
+    def __init__(self, map_func, nx, ny, ng=1,
+                 xmin=0.0, xmax=1.0, ymin=0.0, ymax=1.0):
+        """
+        Create a MappedGrid2d object.
+
+        In addition to the arguments of Grid2d, we take a function
+        map_func which, given the grid object, returns a 2-component
+        sympy Matrix describing the physical coordinates (X, Y) in
+        terms of the computational coordinates (the module-level
+        symbols x and y).
+
+        Parameters
+        ----------
+        map_func : function
+            The function describing the map from computational to
+            physical coordinates
+        nx : int
+            Number of zones in the x-direction
+        ny : int
+            Number of zones in the y-direction
+        ng : int, optional
+            Number of ghost cells
+        xmin : float, optional
+            Computational coordinate at the lower x boundary
+        xmax : float, optional
+            Computational coordinate at the upper x boundary
+        ymin : float, optional
+            Computational coordinate at the lower y boundary
+        ymax : float, optional
+            Computational coordinate at the upper y boundary
+        """
+
+        # pylint: disable=too-many-arguments
+
+        super().__init__(nx, ny, ng=ng,
+                         xmin=xmin, xmax=xmax, ymin=ymin, ymax=ymax)
+
+        # append the out-of-plane coordinate so that the map is a
+        # 3-vector and we can take cross products of the coordinate
+        # tangent vectors.  We store the components as a plain tuple
+        # rather than a sympy Matrix -- sympy operates noticeably
+        # faster on bare expressions, and a tuple is hashable, so the
+        # symbolic manipulations below can be cached.
+        _m = map_func(self)
+        self.map = (_m[0], _m[1], z)
+
+        # the center and interface coordinates as 1-d vectors reshaped
+        # for broadcasting -- the interface ones are just the left-edge
+        # coordinates the base grid already carries.  These four small
+        # buffers are shared by all the metric evaluations, so each
+        # coordinate array is only read (and shifted) once.
+        self._xc = self.x[:, np.newaxis]
+        self._yc = self.y[np.newaxis, :]
+        self._xf = self.xl[:, np.newaxis]
+        self._yf = self.yl[np.newaxis, :]
+
+        # the evaluated line elements and rotation-matrix entries on
+        # the interfaces, cached per direction
+        self._face_terms = {}
+
+        self.kappa, self.hx, self.hy = self.calculate_metric_elements()
+
+        self.R_fcx, self.R_fcy = self.calculate_rotation_matrices()
+
+        # compile the map components once here, so physical_coords
+        # does not pay the lambdify cost on every call
+        self._xmap = sympy.lambdify((x, y), self.map[0], modules="numpy")
+        self._ymap = sympy.lambdify((x, y), self.map[1], modules="numpy")
+
+    @staticmethod
+    def norm(vec):
+        """ the norm of a symbolic vector """
+        return _norm(vec)
+
+    def sym_area_element(self):
+        """
+        symbolically calculate the area element of a cell, dA, as the
+        norm of the cross product of the coordinate tangent vectors.
+        """
+
+        return _sym_area_element(self.map)
+
+    def sym_line_elements(self):
+        """
+        symbolically calculate the line elements of the cell faces --
+        hx is the length of an x-interface (per unit computational y),
+        hy the length of a y-interface.
+        """
+
+        return _sym_line_elements(self.map)
+
+    def sym_rotation_matrix(self):
+        """
+        symbolically calculate the rotation matrices Rx and Ry that
+        take a vector from the computational frame into the frame
+        normal and tangential to the x- and y-interfaces.  The rows
+        are the (normalized) coordinate tangent vectors.
+        """
+
+        return _sym_rotation_matrix(self.map)
+
+    def _face_metric_terms(self, idir):
+        """
+        evaluate the line element and the 2x2 rotation-matrix block on
+        the idir-interfaces.  The line element and the matrix entries
+        share the map's derivatives, so we evaluate them through a
+        single lambdified call with common subexpression elimination.
+        """
+
+        if idir not in self._face_terms:
+            sym_hx, sym_hy = self.sym_line_elements()
+            sym_Rx, sym_Ry = self.sym_rotation_matrix()
+
+            # we pass the coordinates as 1-d vectors and let numpy
+            # broadcast them, rather than materializing full qx x qy
+            # meshgrids for every shifted evaluation
+            if idir == 1:
+                sym_h, sym_R = sym_hx, sym_Rx
+                xs = self._xf
+                ys = self._yc
+            else:
+                sym_h, sym_R = sym_hy, sym_Ry
+                xs = self._xc
+                ys = self._yf
+
+            exprs = [sym_h,
+                     sym_R[0, 0], sym_R[0, 1], sym_R[1, 0], sym_R[1, 1]]
+
+            if numba is not None:
+                # compile each expression into its own parallel ufunc.
+                # LLVM takes care of sharing subexpressions within a
+                # kernel, and the grid loop runs across cores.
+                results = [_lambdify_grid(e)(xs, ys) for e in exprs]
+            else:
+                # without numba, evaluate everything through a single
+                # lambdified call with common subexpression
+                # elimination across the expressions
+                F = sympy.lambdify((x, y), exprs,
+                                   modules="numpy", cse=True)
+                results = F(xs, ys)
+
+            # force the results to float64 -- a constant entry can
+            # come back as an exact (object) sympy number, and we do
+            # not want that cast repeated on every later read
+            h, r00, r01, r10, r11 = \
+                [np.broadcast_to(np.asarray(r, dtype=np.float64),
+                                 (self.qx, self.qy))
+                 for r in results]
+
+            R = np.empty((self.qx, self.qy, 2, 2), dtype=np.float64)
+            R[:, :, 0, 0] = r00
+            R[:, :, 0, 1] = r01
+            R[:, :, 1, 0] = r10
+            R[:, :, 1, 1] = r11
+
+            self._face_terms[idir] = (h, R)
+
+        return self._face_terms[idir]
+
+    def calculate_metric_elements(self):
+        """
+        calculate the metric terms on the grid: the area element kappa
+        at cell centers and the line elements hx, hy on the x- and
+        y-interfaces.
+        """
+
+        sym_dA = self.sym_area_element()
+        sym_hx, sym_hy = self.sym_line_elements()
+
+        # stringifying a large sympy expression walks its whole tree,
+        # so only the logger's lazy formatting pays that cost, and
+        # only when debugging
+        log.debug("dA = %s", sym_dA)
+        log.debug("hx = %s", sym_hx)
+        log.debug("hy = %s", sym_hy)
+
+        kappa = self.scratch_array()
+        hx = self.scratch_array()
+        hy = self.scratch_array()
+
+        # evaluate the area element on the whole grid at once,
+        # exploiting separability of the expression where possible
+        kappa[:, :] = _eval_grid(sym_dA, self._xc, self._yc,
+                                 (self.qx, self.qy))
+
+        # the line elements share the map's derivatives with the
+        # rotation-matrix entries, so they are evaluated together
+        hx[:, :] = self._face_metric_terms(1)[0]
+        hy[:, :] = self._face_metric_terms(2)[0]
+
+        return kappa, hx, hy
+
+    def calculate_rotation_matrices(self):
+        """
+        calculate the rotation matrices on the cell interfaces.  This
+        returns two functions which build the (qx, qy, 2, 2) matrices
+        that rotate the momentum components for all the zones.
+        """
+
+        sym_Rx, sym_Ry = self.sym_rotation_matrix()
+
+        log.debug("Rx = %s", sym_Rx)
+        log.debug("Ry = %s", sym_Ry)
+
+        def make_R_fc(idir):
+            # only the 2x2 momentum block of the rotation is ever
+            # non-identity, so that is all we store and hand out --
+            # for nvar variables this is an (nvar/2)^2 saving in
+            # memory and in the bandwidth of the solver's rotate step
+            def R_fc():
+                return ai.ArrayIndexer(
+                    d=self._face_metric_terms(idir)[1].copy(),
+                    grid=self)
+            return R_fc
+
+        return make_R_fc(1), make_R_fc(2)
+
+    def dense_rotation_matrices(self, idir, nvar, ixmom, iymom):
+        """
+        build the full (qx, qy, nvar, nvar) rotation matrices on the
+        idir-interfaces, with the 2x2 momentum block embedded in the
+        identity.  This is a compatibility path -- the solvers should
+        prefer the compact 2x2 form from R_fcx / R_fcy and only rotate
+        the momentum components.
+        """
+
+        # start from one broadcast copy of the identity -- this
+        # avoids first zeroing the array and then overwriting it
+        R = ai.ArrayIndexer(
+            d=np.broadcast_to(
+                np.eye(nvar), (self.qx, self.qy, nvar, nvar)).copy(),
+            grid=self)
+        R[:, :, ixmom:iymom+1, ixmom:iymom+1] = \
+            self._face_metric_terms(idir)[1]
+        return R
+
+    def physical_coords(self, xs=None, ys=None):
+        """
+        map the computational coordinates to the physical coordinates.
+        If no coordinates are given, the zone centers are used.
+        """
+
+        if xs is None:
+            xs = self.x2d
+        if ys is None:
+            ys = self.y2d
+
+        return np.broadcast_to(self._xmap(xs, ys), np.shape(xs)), \
+            np.broadcast_to(self._ymap(xs, ys), np.shape(ys))
+
+    def scratch_array(self, nvar=1):
+        """
+        return a standard numpy array dimensioned to have the size
+        and number of ghostcells as the parent grid.  nvar may be a
+        (possibly nested) tuple to allocate multiple components per
+        zone.
+        """
+
+        if nvar == 1:
+            _tmp = np.zeros((self.qx, self.qy), dtype=np.float64)
+        else:
+            _tmp = np.zeros((self.qx, self.qy) + tuple(np.ravel(nvar)),
+                            dtype=np.float64)
+        return ai.ArrayIndexer(d=_tmp, grid=self)
+
+
+class MappedCellCenterData2d(CellCenterData2d):
+    """
+    A class to define cell-centered data that lives on a mapped grid.
+    In addition to the state data, this carries the rotation matrices
+    on the cell interfaces, which the solvers use to rotate the
+    velocity into the interface frame.
+    """
+
+    def __init__(self, grid, dtype=np.float64):
+
+        super().__init__(grid, dtype=dtype)
+
+        self.R_fcx = None
+        self.R_fcy = None
+
+        self.ixmom = None
+        self.iymom = None
+
+    def make_rotation_matrices(self, ivars):
+        """
+        build the rotation matrices on the cell interfaces, given the
+        variable indices in ivars.  The matrices are the compact
+        (qx, qy, 2, 2) momentum blocks -- to rotate a state U, apply
+        them to U[..., ixmom:iymom+1].
+        """
+
+        self.ixmom = ivars.ixmom
+        self.iymom = ivars.iymom
+
+        self.R_fcx = self.grid.R_fcx()
+        self.R_fcy = self.grid.R_fcy()
+
+
+def mapped_cell_center_data_clone(old):
+    """
+    Create a new MappedCellCenterData2d object that is a copy of an
+    existing one
+
+    Parameters
+    ----------
+    old : MappedCellCenterData2d object
+        The MappedCellCenterData2d object we wish to copy
+
+    """
+
+    if not isinstance(old, MappedCellCenterData2d):
+        msg.fail("Can't clone object")
+
+    # deepcopy takes care of the data, the BCs, and the rotation
+    # matrices in one go, without re-running the variable registration
+    # and BC bookkeeping per variable.  The grid is immutable for our
+    # purposes, so share it instead of copying.
+    return copy.deepcopy(old, {id(old.grid): old.grid})
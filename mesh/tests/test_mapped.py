@@ -0,0 +1,165 @@
+# unit tests for mapped grids
+import numpy as np
+import sympy
+
+from numpy.testing import assert_array_almost_equal
+
+import mesh.boundary as bnd
+import mesh.mapped as mapped
+
+
+def identity_map(myg):
+    """ the identity map -- physical coords = computational coords """
+    return sympy.Matrix([mapped.x, mapped.y])
+
+
+def polar_map(myg):
+    """ a polar map -- x is the radius, y the angle """
+    return sympy.Matrix([mapped.x * sympy.cos(mapped.y),
+                         mapped.x * sympy.sin(mapped.y)])
+
+
+class FakeIvars(object):
+    """ the minimal set of variable indices needed for the rotation
+    matrices """
+    def __init__(self, nvar=4, ixmom=1, iymom=2):
+        self.nvar = nvar
+        self.ixmom = ixmom
+        self.iymom = iymom
+
+
+class TestMappedGrid2dIdentity(object):
+
+    def setup_method(self):
+        """ this is run before each test """
+        self.g = mapped.MappedGrid2d(identity_map, 4, 6, ng=2, ymax=1.5)
+
+    def teardown_method(self):
+        """ this is run after each test """
+        self.g = None
+
+    def test_metric_elements(self):
+        assert_array_almost_equal(self.g.kappa, np.ones((self.g.qx, self.g.qy)))
+        assert_array_almost_equal(self.g.hx, np.ones((self.g.qx, self.g.qy)))
+        assert_array_almost_equal(self.g.hy, np.ones((self.g.qx, self.g.qy)))
+
+    def test_rotation_matrices(self):
+        R_fcx = self.g.R_fcx()
+        assert R_fcx.shape == (self.g.qx, self.g.qy, 2, 2)
+        assert_array_almost_equal(
+            R_fcx, np.broadcast_to(np.eye(2),
+                                   (self.g.qx, self.g.qy, 2, 2)))
+
+    def test_physical_coords(self):
+        xs, ys = self.g.physical_coords()
+        assert_array_almost_equal(xs, self.g.x2d)
+        assert_array_almost_equal(ys, self.g.y2d)
+
+    def test_scratch_array(self):
+        q = self.g.scratch_array(nvar=(2, 2))
+        assert q.shape == (self.g.qx, self.g.qy, 2, 2)
+
+
+class TestMappedGrid2dPolar(object):
+
+    def setup_method(self):
+        """ this is run before each test """
+        self.g = mapped.MappedGrid2d(polar_map, 4, 6, ng=2,
+                                     xmin=0.5, xmax=1.0,
+                                     ymin=0.0, ymax=1.0)
+
+    def teardown_method(self):
+        """ this is run after each test """
+        self.g = None
+
+    def test_metric_elements(self):
+        # dA = r, the x-interfaces have length r dtheta, and the
+        # y-interfaces have length dr
+        assert_array_almost_equal(self.g.kappa, self.g.x2d)
+        assert_array_almost_equal(self.g.hx, self.g.x2d - 0.5*self.g.dx)
+        assert_array_almost_equal(self.g.hy, np.ones((self.g.qx, self.g.qy)))
+
+    def test_rotation_matrices(self):
+        R_fcx = self.g.R_fcx()
+
+        ys = self.g.y2d
+        assert_array_almost_equal(R_fcx[:, :, 0, 0], np.cos(ys))
+        assert_array_almost_equal(R_fcx[:, :, 0, 1], np.sin(ys))
+        assert_array_almost_equal(R_fcx[:, :, 1, 0], -np.sin(ys))
+        assert_array_almost_equal(R_fcx[:, :, 1, 1], np.cos(ys))
+
+    def test_dense_rotation_matrices(self):
+        nvar = 4
+        R_fcx = self.g.dense_rotation_matrices(1, nvar, 1, 2)
+        R_block = self.g.R_fcx()
+
+        assert R_fcx.shape == (self.g.qx, self.g.qy, nvar, nvar)
+        assert_array_almost_equal(R_fcx[:, :, 1:3, 1:3], R_block)
+
+        # the non-momentum variables are not rotated
+        assert_array_almost_equal(R_fcx[:, :, 0, 0],
+                                  np.ones((self.g.qx, self.g.qy)))
+        assert_array_almost_equal(R_fcx[:, :, 3, 3],
+                                  np.ones((self.g.qx, self.g.qy)))
+
+    def test_physical_coords(self):
+        xs, ys = self.g.physical_coords()
+        assert_array_almost_equal(xs, self.g.x2d*np.cos(self.g.y2d))
+        assert_array_almost_equal(ys, self.g.x2d*np.sin(self.g.y2d))
+
+
+def test_rotation_matrix_orthogonality():
+    # R R^T = I must hold for an orthogonal map -- this used to be
+    # checked on every grid construction, now only here
+    for map_func in [identity_map, polar_map]:
+        myg = mapped.MappedGrid2d(map_func, 4, 4, ng=2,
+                                  xmin=0.5, xmax=1.0)
+        Rx, Ry = myg.sym_rotation_matrix()
+
+        xx = np.random.rand()
+        yy = np.random.rand()
+
+        for R in [Rx, Ry]:
+            assert_array_almost_equal(
+                np.array((R @ R.T).subs({mapped.x: xx, mapped.y: yy}),
+                         dtype=np.float64),
+                np.eye(2))
+
+
+def test_mapped_cell_center_data_clone():
+
+    myg = mapped.MappedGrid2d(polar_map, 4, 4, ng=2,
+                              xmin=0.5, xmax=1.0, ymin=0.0, ymax=1.0)
+    myd = mapped.MappedCellCenterData2d(myg)
+
+    bco = bnd.BC(xlb="outflow", xrb="outflow",
+                 ylb="outflow", yrb="outflow")
+    myd.register_var("density", bco)
+    myd.register_var("x-momentum", bco)
+    myd.register_var("y-momentum", bco)
+    myd.register_var("energy", bco)
+    myd.create()
+
+    myd.make_rotation_matrices(FakeIvars())
+
+    a = myd.get_var("density")
+    a[:, :] = np.random.rand(myg.qx, myg.qy)
+
+    new = mapped.mapped_cell_center_data_clone(myd)
+
+    assert new.names == myd.names
+    assert new.grid is myd.grid
+    assert_array_almost_equal(new.data, myd.data)
+    assert_array_almost_equal(new.R_fcx, myd.R_fcx)
+    assert_array_almost_equal(new.R_fcy, myd.R_fcy)
+
+    # the BCs must survive the clone
+    for name in myd.names:
+        assert new.BCs[name].xlb == myd.BCs[name].xlb
+        assert new.BCs[name].yrb == myd.BCs[name].yrb
+    new.fill_BC_all()
+
+    # the clone's data should be independent of the original's
+    b = new.get_var("density")
+    b[:, :] = 0.0
+    assert myd.max("density") > 0.0